@@ -1,12 +1,65 @@
 #!/usr/bin/env python3
 
-import json
+import argparse
 import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import numpy as np
 import cv2
 from pycocotools import mask as mask_utils
 from tqdm import tqdm
 
+from utils.json_utils import dump_json, load_json
+
+MAX_DECODE_PIXELS = 1 << 28  # max mask pixels decoded per batch (256 MB of uint8 masks)
+
+def save_coco_json(data, annotations, path, pretty=False):
+    """
+    Save COCO data with its annotations replaced by annotations, streaming them to the file one at a time
+    
+    Produces compact JSON with one annotation per line (or the 2-space indented layout of dumping the whole
+    updated dict if pretty), without building it or holding the serialized document in memory.
+    """
+    if pretty:
+        newline, item_newline, end_newline, key_sep = b'\n  ', b'\n    ', b'\n  ', b': '
+    else:
+        newline, item_newline, end_newline, key_sep = b'', b'\n', b'\n', b':'
+    keys = list(data) + ([] if 'annotations' in data else ['annotations'])
+    with open(path, 'wb') as f:
+        f.write(b'{')
+        for i, key in enumerate(keys):
+            f.write(b',' + newline if i else newline)
+            f.write(dump_json(key) + key_sep)
+            if key != 'annotations':
+                f.write(dump_json(data[key], pretty).replace(b'\n', newline))  # re-indent nested value
+            elif annotations:
+                for j, ann in enumerate(annotations):
+                    f.write((b',' if j else b'[') + item_newline)
+                    f.write(dump_json(ann, pretty).replace(b'\n', item_newline))
+                f.write(end_newline + b']')
+            else:
+                f.write(b'[]')
+        f.write(b'\n}' if keys and pretty else b'}')
+
+def write_text(path, text):
+    """Write text to a file"""
+    with open(path, 'w') as f:
+        f.write(text)
+
+def decode_rles(rles):
+    """
+    Decode RLE masks of the same size, and their bounding boxes, in single pycocotools calls
+    
+    Args:
+        rles: List of RLE encoded masks (compressed or uncompressed counts), all with the same 'size'
+        
+    Returns:
+        Binary masks as a (height, width, len(rles)) uint8 array and their
+        [x, y, width, height] bounding boxes as a (len(rles), 4) array
+    """
+    rles = [mask_utils.frPyObjects(rle, *rle['size']) if isinstance(rle['counts'], list) else rle
+            for rle in rles]
+    return mask_utils.decode(rles), mask_utils.toBbox(rles)
+
 def rle_to_yolo_polygon(rle, img_height, img_width, simplify=True, epsilon=1.0):
     """
     Convert RLE mask to YOLO polygon format
@@ -19,40 +72,68 @@ def rle_to_yolo_polygon(rle, img_height, img_width, simplify=True, epsilon=1.0):
         epsilon: Approximation accuracy parameter for simplification
         
     Returns:
-        List of normalized polygon coordinates [x1, y1, x2, y2, ...]
+        List of normalized polygon coordinates [x1, y1, x2, y2, ...] and the raw pixel coordinates
     """
     # Decode RLE to binary mask
     if isinstance(rle, list):
         rle = {'counts': rle, 'size': [img_height, img_width]}
-    binary_mask = mask_utils.decode(rle)
+    masks, bboxes = decode_rles([rle])
+    points = mask_to_polygon(masks[..., 0], simplify, epsilon, bboxes[0])
+    if not len(points):
+        return [], []  # No contours found
+    
+    # Normalize coordinates to 0-1 range
+    normalized = (points / np.array([img_width, img_height], dtype=np.float64)).ravel().tolist()
+    
+    return normalized, points.flatten().tolist()
+
+def mask_to_polygon(binary_mask, simplify=True, epsilon=1.0, bbox=None):
+    """
+    Trace the largest contour of a binary mask as a polygon in pixel coordinates
     
-    # Find contours
-    contours, _ = cv2.findContours(binary_mask.astype(np.uint8), 
+    Args:
+        binary_mask: HxW binary mask
+        simplify: Whether to simplify contours
+        epsilon: Approximation accuracy parameter for simplification
+        bbox: Optional [x, y, width, height] bounding box of the mask (e.g. from RLE), limits the contour search
+        
+    Returns:
+        Polygon points as an Nx2 int array, empty if no contours were found
+    """
+    # Only scan the bounding box plus a 1 pixel empty border, contours are offset back to image coordinates
+    x0, y0 = 0, 0
+    if bbox is not None:
+        x, y, w, h = bbox
+        x0, y0 = max(int(x) - 1, 0), max(int(y) - 1, 0)
+        x1, y1 = min(int(x + w) + 1, binary_mask.shape[1]), min(int(y + h) + 1, binary_mask.shape[0])
+        binary_mask = binary_mask[y0:y1, x0:x1]
+    
+    # Find contours (pycocotools decodes uint8 masks in column-major order, which OpenCV would
+    # copy anyway, so convert once here instead of an astype copy followed by OpenCV's own)
+    contours, _ = cv2.findContours(np.ascontiguousarray(binary_mask, dtype=np.uint8), 
                                    cv2.RETR_EXTERNAL, 
-                                   cv2.CHAIN_APPROX_SIMPLE)
+                                   cv2.CHAIN_APPROX_SIMPLE,
+                                   offset=(x0, y0))
     
     # Get the largest contour (main object)
     if not contours:
-        return []  # No contours found
+        return np.empty((0, 2), dtype=np.int32)  # No contours found
         
-    largest_contour = max(contours, key=cv2.contourArea)
+    largest_contour = select_largest_contour(contours)
     
-    # Simplify the contour if requested
-    if simplify:
+    # Simplify the contour if requested (single point contours have nothing to simplify)
+    if simplify and len(largest_contour) > 1:
         largest_contour = cv2.approxPolyDP(largest_contour, 
                                           epsilon, 
                                           closed=True)
     
-    # Convert to format needed for YOLO
-    flattened = largest_contour.flatten().tolist()
-    
-    # Normalize coordinates to 0-1 range
-    normalized = []
-    for i in range(0, len(flattened), 2):
-        normalized.append(flattened[i] / img_width)      # x
-        normalized.append(flattened[i+1] / img_height)   # y
-    
-    return normalized, flattened
+    return largest_contour.reshape(-1, 2)
+
+def select_largest_contour(contours):
+    """Return the contour with the largest area"""
+    if len(contours) == 1:
+        return contours[0]  # common single-object case, no area computation needed
+    return max(contours, key=cv2.contourArea)
 
 def normalize_bb(bbox, img_h, img_w):
     """Get bounding box from bounding box"""
@@ -68,7 +149,80 @@ def normalize_bb(bbox, img_h, img_w):
 
     return [x_center, y_center, bb_width, bb_height]
 
-def convert_json_to_yolo_labels(json_path, output_dir, dataset_type='train'):#, img_source_dir=None):
+def process_image_annotations(anns, img_height, img_width):
+    """
+    Convert the annotations of one image to YOLO polygons
+    
+    Args:
+        anns: List of (index, annotation) pairs belonging to the image
+        img_height: Image height
+        img_width: Image width
+        
+    Returns:
+        List of (index, category_id, points, new_annotation) for the annotations that could be converted,
+        where points is the Nx2 polygon in pixel coordinates
+    """
+    results = []
+    
+    # Decode the RLE masks (usually has 'counts' and 'size') of this image in as few batches as memory allows,
+    # masks not at the image size are decoded on their own at their own size
+    image_size = [img_height, img_width]
+    rles = [ann['segmentation'] for _, ann in anns
+            if 'counts' in ann['segmentation'] and list(ann['segmentation']['size']) == image_size]
+    batch_size = max(MAX_DECODE_PIXELS // (img_height * img_width), 1)
+    mask_idx = 0
+    
+    for idx, ann in anns:
+        category_id = ann['category_id']
+        
+        # Process segmentation based on format
+        # For RLE format (usually has 'counts' and 'size')
+        if 'counts' in ann['segmentation']:
+            if list(ann['segmentation']['size']) == image_size:
+                i = mask_idx % batch_size
+                if i == 0:
+                    masks, bboxes = decode_rles(rles[mask_idx:mask_idx + batch_size])
+                binary_mask, bbox = masks[..., i], bboxes[i]
+                mask_idx += 1
+            else:
+                own_masks, own_bboxes = decode_rles([ann['segmentation']])
+                binary_mask, bbox = own_masks[..., 0], own_bboxes[0]
+            points = mask_to_polygon(binary_mask, bbox=bbox)
+            
+            # Skip if no contours found
+            if not len(points):
+                print(f"Warning: No contours found for annotation {ann['id']}. Skipping.")
+                continue
+            
+            # For updated JSON output - replace RLE with polygon format
+            new_ann = ann.copy()
+            new_ann['segmentation'] = [points.flatten().tolist()]  # COCO polygon format: [[x1, y1, x2, y2, ...]]
+            results.append((idx, category_id, points, new_ann))
+            
+        # For polygon format (list or list of lists of coordinates)
+        elif isinstance(ann['segmentation'], list):
+            # Already in polygon format, normalized for YOLO with all other polygons
+            poly_list = ann['segmentation']
+            
+            # Flatten if needed (COCO can have multiple polygons per object)
+            if isinstance(poly_list[0], list):
+                # Take the largest polygon if there are multiple
+                largest_poly = max(poly_list, key=len)
+                poly_points = largest_poly
+            else:
+                poly_points = poly_list
+            
+            points = np.asarray(poly_points, dtype=np.float64).reshape(-1, 2)
+            
+            # Keep original annotation for JSON output
+            results.append((idx, category_id, points, ann))
+        else:
+            print(f"Warning: Unknown segmentation format in annotation {ann['id']}. Skipping.")
+            continue
+    
+    return results
+
+def convert_json_to_yolo_labels(json_path, output_dir, dataset_type='train', workers=None, pretty=False):#, img_source_dir=None):
     """
     Convert annotations from JSON with RLE masks to YOLO segmentation format
     
@@ -76,6 +230,8 @@ def convert_json_to_yolo_labels(json_path, output_dir, dataset_type='train'):#,
         json_path: Path to JSON annotation file
         output_dir: Directory to save YOLO labels
         dataset_type: train, val, or test
+        workers: Number of worker processes for annotation conversion (None uses all CPUs)
+        pretty: Write the polygon JSON with 2-space indentation instead of compact
         img_source_dir: Directory containing source images (if copying)
     """
     # Create output directories
@@ -86,17 +242,13 @@ def convert_json_to_yolo_labels(json_path, output_dir, dataset_type='train'):#,
     
     # Load JSON file
     print(f"Loading annotations from {json_path}...")
-    with open(json_path, 'r') as f:
-        data = json.load(f)
+    data = load_json(json_path)
     
-    # Create image id to file name mapping
-    image_id_to_info = {}
-    for image in data['images']:
-        image_id_to_info[image['id']] = {
-            'file_name': image['file_name'],
-            'width': image['width'],
-            'height': image['height']
-        }
+    # Image table as parallel arrays indexed by row, with an image id to row mapping
+    id_to_row = {image['id']: row for row, image in enumerate(data['images'])}
+    widths = np.fromiter((image['width'] for image in data['images']), dtype=np.int32, count=len(data['images']))
+    heights = np.fromiter((image['height'] for image in data['images']), dtype=np.int32, count=len(data['images']))
+    file_names = [image['file_name'] for image in data['images']]
     
     # Create category id to index mapping (YOLO uses indices starting from 0)
     if 'categories' in data:
@@ -112,12 +264,19 @@ def convert_json_to_yolo_labels(json_path, output_dir, dataset_type='train'):#,
                 unique_cats.add(ann['category_id'])
         category_mapping = {cat_id: idx for idx, cat_id in enumerate(sorted(unique_cats))}
         
-    # Process annotations and create new annotations with polygon segmentation
-    new_annotations = []
-    image_annotations = {}
-    
-    print(f"Processing annotations for {dataset_type} set...")
-    for ann in tqdm(data['annotations']):
+    # Category id to class index lookup table, gathered for all polygons at once. Only used for small
+    # non-negative int ids, other ids (negative, sparse, strings) keep the dict lookup
+    category_lut = None
+    if category_mapping and all(type(cat_id) is int and cat_id >= 0 for cat_id in category_mapping):
+        max_id = max(category_mapping)
+        if max_id < 4 * len(category_mapping) + 1024:
+            category_lut = np.full(max_id + 1, -1, dtype=np.int32)
+            for cat_id, idx in category_mapping.items():
+                category_lut[cat_id] = idx
+        
+    # Validate annotations and group them by image row so RLE masks can be decoded per image
+    row_to_anns = {}
+    for idx, ann in enumerate(data['annotations']):
         # Check if this is a valid annotation with required fields
         if not all(key in ann for key in ['id', 'image_id', 'category_id', 'segmentation']):
             # Check if this seems to be a truncated annotation (just ID)
@@ -128,80 +287,66 @@ def convert_json_to_yolo_labels(json_path, output_dir, dataset_type='train'):#,
             continue
         
         image_id = ann['image_id']
-        if image_id not in image_id_to_info:
+        row = id_to_row.get(image_id)
+        if row is None:
             print(f"Warning: Image ID {image_id} not found in images list. Skipping annotation {ann['id']}.")
             continue
-            
-        img_info = image_id_to_info[image_id]
-        img_width, img_height = img_info['width'], img_info['height']
         
-        # Initialize image annotations entry if not exists
-        if image_id not in image_annotations:
-            image_annotations[image_id] = []
+        if ann['category_id'] not in category_mapping:
+            raise KeyError(f"Category ID {ann['category_id']} not found in categories")
         
-        category_id = ann['category_id']
-        class_idx = category_mapping[category_id]
-        
-        # Process segmentation based on format
-        # For RLE format (usually has 'counts' and 'size')
-        if 'counts' in ann['segmentation']:
-            rle = ann['segmentation']
-            yolo_polygon, raw_polygon = rle_to_yolo_polygon(rle, img_height, img_width)
-            
-            # Skip if no contours found
-            if not yolo_polygon:
-                print(f"Warning: No contours found for annotation {ann['id']}. Skipping.")
-                continue
-                
-            # For YOLO format label file
-            image_annotations[image_id].append((class_idx, yolo_polygon))
-            
-            # For updated JSON output - replace RLE with polygon format
-            new_ann = ann.copy()
-            new_ann['segmentation'] = [raw_polygon]  # COCO polygon format: [[x1, y1, x2, y2, ...]]
-            new_annotations.append(new_ann)
-            
-        # For polygon format (list or list of lists of coordinates)
-        elif isinstance(ann['segmentation'], list):
-            # Already in polygon format, just normalize for YOLO
-            poly_list = ann['segmentation']
-            
-            # Flatten if needed (COCO can have multiple polygons per object)
-            if isinstance(poly_list[0], list):
-                # Take the largest polygon if there are multiple
-                largest_poly = max(poly_list, key=len)
-                poly_points = largest_poly
-            else:
-                poly_points = poly_list
-            
-            # Normalize polygon coordinates
-            yolo_polygon = []
-            for i in range(0, len(poly_points), 2):
-                yolo_polygon.append(poly_points[i] / img_width)
-                yolo_polygon.append(poly_points[i+1] / img_height)
-            
-            # Add to image annotations for YOLO label file
-            image_annotations[image_id].append((class_idx, yolo_polygon))
-            
-            # Keep original annotation for JSON output
-            new_annotations.append(ann)
-        else:
-            print(f"Warning: Unknown segmentation format in annotation {ann['id']}. Skipping.")
-            continue
+        row_to_anns.setdefault(row, []).append((idx, ann))
+    
+    # Process annotations and create new annotations with polygon segmentation, one image per task
+    new_annotations = [None] * len(data['annotations'])  # kept in input order
+    image_annotations = {}  # image row -> [polygon index]
+    polygons, polygon_rows, polygon_categories = [], [], []
+    
+    print(f"Processing annotations for {dataset_type} set...")
+    rows = np.fromiter(row_to_anns, dtype=np.intp, count=len(row_to_anns))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(process_image_annotations,
+                               row_to_anns.values(),
+                               heights[rows].tolist(),
+                               widths[rows].tolist(),
+                               chunksize=16)
+        for row, image_results in tqdm(zip(rows.tolist(), results), total=len(rows)):
+            image_annotations[row] = []
+            for idx, category_id, points, new_ann in image_results:
+                image_annotations[row].append(len(polygons))
+                polygons.append(points)
+                polygon_rows.append(row)
+                polygon_categories.append(category_id)
+                new_annotations[idx] = new_ann
+    new_annotations = [ann for ann in new_annotations if ann is not None]
     
-    # Write YOLO label files
+    # Normalize all polygons at once, dividing every point by the (width, height) of its image
+    lengths = np.fromiter((len(points) for points in polygons), dtype=np.intp, count=len(polygons))
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    all_points = np.concatenate(polygons) if polygons else np.empty((0, 2))
+    image_wh = np.stack([widths, heights], axis=1)[polygon_rows]
+    normalized = all_points / np.repeat(image_wh, lengths, axis=0)
+    
+    # Map all category ids to YOLO class indices
+    if category_lut is not None:
+        class_indices = category_lut[np.array(polygon_categories, dtype=np.intp)].tolist()
+    else:
+        class_indices = [category_mapping[category_id] for category_id in polygon_categories]
+    
+    # Format YOLO label files
     print("Writing YOLO label files...")
-    for image_id, annotations in tqdm(image_annotations.items()):
-        img_info = image_id_to_info[image_id]
-        file_name = img_info['file_name']
-        base_name = os.path.splitext(file_name)[0]
-        
-        # Write label file
-        label_path = os.path.join(labels_dir, f"{base_name}.txt")
-        with open(label_path, 'w') as f:
-            for class_idx, polygon in annotations:
-                polygon_str = ' '.join([f"{coord:.6f}" for coord in polygon])
-                f.write(f"{class_idx} {polygon_str}\n")
+    label_contents = {}
+    label_prefix = os.path.join(labels_dir, '')
+    label_paths = [f"{label_prefix}{os.path.splitext(file_names[row])[0]}.txt" for row in image_annotations]
+    for label_path, annotations in tqdm(zip(label_paths, image_annotations.values()), total=len(label_paths)):
+        # Format label file
+        lines = []
+        for k in annotations:
+            class_idx = class_indices[k]
+            polygon = normalized[offsets[k]:offsets[k + 1]].ravel().tolist()
+            polygon_str = ' '.join(['%.6f'] * len(polygon)) % tuple(polygon)  # one format call per polygon
+            lines.append(f"{class_idx} {polygon_str}\n")
+        label_contents[label_path] = ''.join(lines)
         
         # # Copy image if source directory provided
         # if img_source_dir:
@@ -212,17 +357,17 @@ def convert_json_to_yolo_labels(json_path, output_dir, dataset_type='train'):#,
         #     else:
         #         print(f"Warning: Source image {src_path} not found.")
     
+    # Write label files with a thread pool, the many small writes are I/O bound
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        list(executor.map(write_text, label_contents.keys(), label_contents.values()))
+    
     # Save updated JSON with polygon segmentations
     base_name = os.path.basename(json_path)
     name_parts = os.path.splitext(base_name)
     new_json_path = os.path.join(output_dir, f"{name_parts[0]}_polygon{name_parts[1]}")
     
-    # Update annotations in the data
-    data['annotations'] = new_annotations
-    
     print(f"Writing updated JSON with polygon segmentations to {new_json_path}...")
-    with open(new_json_path, 'w') as f:
-        json.dump(data, f, indent=2)
+    save_coco_json(data, new_annotations, new_json_path, pretty)
     
     print(f"Finished processing {dataset_type} dataset.")
     print(f"YOLO labels saved to {labels_dir}")
@@ -231,6 +376,10 @@ def convert_json_to_yolo_labels(json_path, output_dir, dataset_type='train'):#,
     return new_json_path
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert COCO RLE/polygon annotations to YOLO segmentation labels')
+    parser.add_argument('--pretty', action='store_true', help='write polygon JSON files with indentation')
+    opt = parser.parse_args()
+
     # Example usage
     json_path = "./med_data/medtool_train_anns.json"
     output_dir = "./data/dataset"
@@ -245,13 +394,13 @@ if __name__ == "__main__":
 
     # Convert training annotations
     print("\n=== Processing Training Data ===")
-    convert_json_to_yolo_labels(json_path, output_dir, 'train')
+    convert_json_to_yolo_labels(json_path, output_dir, 'train', pretty=opt.pretty)
     
     # Convert validation annotations
     val_json_path = "./med_data/medtool_val_anns.json"
     if os.path.exists(val_json_path):
         print("\n=== Processing Validation Data ===")
-        convert_json_to_yolo_labels(val_json_path, output_dir, 'val')#, img_source_dir)
+        convert_json_to_yolo_labels(val_json_path, output_dir, 'val', pretty=opt.pretty)#, img_source_dir)
     else:
         print(f"\nWarning: Validation JSON {val_json_path} not found. Skipping.")
     
@@ -259,7 +408,7 @@ if __name__ == "__main__":
     test_json_path = "./med_data/medtool_val_anns.json"  # Often reusing validation set
     if os.path.exists(test_json_path):
         print("\n=== Processing Test Data ===")
-        convert_json_to_yolo_labels(test_json_path, output_dir, 'test') #, img_source_dir)
+        convert_json_to_yolo_labels(test_json_path, output_dir, 'test', pretty=opt.pretty) #, img_source_dir)
     else:
         print(f"\nWarning: Test JSON {test_json_path} not found. Skipping.")
 
@@ -5,6 +5,10 @@ from typing import List, Dict, Union
 
 def extract_image_names(json_data: Union[List, Dict], key_name: str = "file_name") -> List[str]:
     """Extract image names from JSON data based on the specified key"""
+    # Fast path for COCO style files, image entries are a flat list under 'images'
+    if isinstance(json_data, dict) and key_name not in json_data and isinstance(json_data.get('images'), list):
+        return [img[key_name] for img in json_data['images'] if isinstance(img, dict) and key_name in img]
+    
     image_names = []
     
     if isinstance(json_data, list):
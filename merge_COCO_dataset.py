@@ -1,7 +1,17 @@
-import json
 from collections import defaultdict
 
-def merge_annotation_files(source_file, target_file, output_file=None):
+from utils.json_utils import load_json, save_json
+
+def image_fingerprint(img):
+    """Fingerprint an image entry by (height, width, file_name)"""
+    return (img.get('height', None), img.get('width', None), img.get('file_name', None))
+
+def image_key(img):
+    """Match an image by its file_name, or by its fingerprint if it has none"""
+    file_name = img.get('file_name', None)
+    return file_name if file_name is not None else image_fingerprint(img)
+
+def merge_annotation_files(source_file, target_file, output_file=None, pretty=False, strict=False):
     """
     Merge annotations from source_file into target_file for images that don't exist in target_file.
     
@@ -9,36 +19,33 @@ def merge_annotation_files(source_file, target_file, output_file=None):
         source_file (str): Path to the source annotations JSON (annotations_singles_updated.json)
         target_file (str): Path to the target annotations JSON (medtool_anns.json)
         output_file (str, optional): Path to save the merged result. If None, overwrites target_file.
+        pretty (bool, optional): Write the result with 2-space indentation instead of compact JSON.
+        strict (bool, optional): Match images by (height, width, file_name) instead of file_name only,
+            for datasets where file names are not unique.
     
     Returns:
         dict: Statistics about the merge operation
     """
     # Load the JSON files
-    with open(source_file, 'r') as f:
-        source_data = json.load(f)
-    
-    with open(target_file, 'r') as f:
-        target_data = json.load(f)
+    source_data = load_json(source_file)
+    target_data = load_json(target_file)
     
     # Extract image IDs from target to identify what's already there
-    # Usually would use 'id' field but we'll create a fingerprint based on available data
-    target_image_fingerprints = set()
-    for img in target_data['images']:
-        # Create a fingerprint for each image (adjust with additional fields if available)
-        fingerprint = (img.get('height', None), img.get('width', None), 
-                      img.get('file_name', None))
-        target_image_fingerprints.add(fingerprint)
+    # Usually would use 'id' field but we'll match on file_name (or a fingerprint based on available data)
+    if strict:
+        target_image_keys = frozenset(image_fingerprint(img) for img in target_data['images'])
+        source_image_keys = map(image_fingerprint, source_data['images'])
+    else:
+        target_image_keys = {image_key(img) for img in target_data['images']}
+        source_image_keys = map(image_key, source_data['images'])
     
     # Track which source images to add
     new_images = []
     new_image_ids = set()
     
     # Find unique images in source that aren't in target
-    for img in source_data['images']:
-        fingerprint = (img.get('height', None), img.get('width', None),
-                     img.get('file_name', None))
-        
-        if fingerprint not in target_image_fingerprints:
+    for img, key in zip(source_data['images'], source_image_keys):
+        if key not in target_image_keys:
             # If source has an id field, track it for annotations
             if 'id' in img:
                 new_image_ids.add(img['id'])
@@ -68,8 +75,7 @@ def merge_annotation_files(source_file, target_file, output_file=None):
     if output_file is None:
         output_file = target_file
     
-    with open(output_file, 'w') as f:
-        json.dump(target_data, f, indent=2)
+    save_json(target_data, output_file, pretty)
     
     return {
         "new_images_added": len(new_images),
@@ -2,9 +2,32 @@ import json
 import random
 import os
 import shutil
+import tempfile
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
 
-def split_coco_dataset_by_category(json_file_path, old_img_dir_path, train_dir, val_dir, train_ratio=0.8):
+def link_or_copy(src, dst_dir):
+    # Hardlink src into dst_dir (no bytes copied), fall back to a copy e.g. across filesystems.
+    # The file is staged under a temporary name and moved onto dst, so an existing dst (possibly a
+    # hardlink to another source image) is replaced and never written into
+    dst = os.path.join(dst_dir, os.path.basename(src))
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return
+    fd, tmp = tempfile.mkstemp(dir=dst_dir, prefix=f'.{os.path.basename(src)}.')
+    os.close(fd)
+    try:
+        os.unlink(tmp)
+        try:
+            os.link(src, tmp)
+        except OSError:
+            shutil.copy(src, tmp)
+        os.replace(tmp, dst)
+    finally:
+        if os.path.lexists(tmp):
+            os.unlink(tmp)
+
+def split_coco_dataset_by_category(json_file_path, old_img_dir_path, train_dir, val_dir, train_ratio=0.8, workers=16):
     # Load the original COCO dataset
     with open(json_file_path, 'r') as file:
         coco_data = json.load(file)
@@ -55,11 +78,14 @@ def split_coco_dataset_by_category(json_file_path, old_img_dir_path, train_dir,
     
     for img_id in train_image_ids:
         train_coco['images'].append(image_id_to_info[img_id])
-        shutil.copy(image_id_to_path[img_id], train_dir)
     
     for img_id in val_image_ids:
         val_coco['images'].append(image_id_to_info[img_id])
-        shutil.copy(image_id_to_path[img_id], val_dir)
+    
+    # Link (or copy) the images with a thread pool, the file operations are I/O bound
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(link_or_copy, [image_id_to_path[img_id] for img_id in train_image_ids], repeat(train_dir)))
+        list(executor.map(link_or_copy, [image_id_to_path[img_id] for img_id in val_image_ids], repeat(val_dir)))
     
     # Save the new JSON files
     with open(os.path.join('medtool_train_anns.json'), 'w') as train_file:
@@ -0,0 +1,25 @@
+import json
+
+try:
+    import orjson  # fast JSON (de)serialization
+except ImportError:  # package not installed, fall back to json
+    orjson = None
+
+
+def load_json(path):
+    """Load a JSON file, using orjson when available"""
+    with open(path, 'rb') as f:
+        return orjson.loads(f.read()) if orjson else json.load(f)
+
+
+def dump_json(obj, pretty=False):
+    """Serialize obj to compact JSON bytes (2-space indented if pretty), using orjson when available"""
+    if orjson:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if pretty else None)
+    return json.dumps(obj, indent=2 if pretty else None, separators=None if pretty else (',', ':')).encode()
+
+
+def save_json(obj, path, pretty=False):
+    """Save obj to a compact (2-space indented if pretty) JSON file, using orjson when available"""
+    with open(path, 'wb') as f:
+        f.write(dump_json(obj, pretty))